@@ -2,7 +2,15 @@
 # The command pattern is a behavioral design pattern designed to decouple the client from the receiver through
 # an invoker. The 'invoker' takes the 'command' from a 'client', and passes it to the 'receiver' to execute it.
 
+import mmap
+import os
+import queue
+import struct
+import tempfile
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import deque
 
 
 # The command interface
@@ -24,11 +32,20 @@ class Robot:
         self.position -= 1
         print("moving backward")
 
+    def move_by(self, steps: int, quiet: bool = False):
+        """Apply a net change in position in a single step"""
+        self.position += steps
+        if not quiet:
+            print(f"moving {steps:+d} steps")
+
     def __str__(self):
         return f"Robot position: {self.position}"
 
 
 class MoveForward(Command):
+    # how far the command moves the robot, lets an invoker fold several commands into one move
+    delta = 1
+
     def __init__(self, robot):
         self.robot = robot
 
@@ -37,6 +54,8 @@ class MoveForward(Command):
 
 
 class MoveBackward(Command):
+    delta = -1
+
     def __init__(self, robot):
         self.robot = robot
 
@@ -50,6 +69,242 @@ class RemoteControl:
         command.execute()
 
 
+class BatchRemoteControl:
+    """
+    An invoker that takes a whole sequence of commands at once. Runs of adjacent commands that move the same robot
+    are folded into one net position change, so the robot is only moved (and prints) once per run.
+    Commands without a 'delta' can't be folded, they're executed as-is.
+    """
+
+    def __init__(self, quiet: bool = False):
+        self.quiet = quiet
+        self.folded = 0
+
+    def press_buttons(self, commands) -> int:
+        """Execute the commands, returns how many commands were folded away by this call"""
+        folded = 0
+        robot, steps, run = None, 0, 0
+        for command in commands:
+            delta = getattr(command, "delta", None)
+            if delta is not None and run and command.robot is robot:
+                steps += delta
+                run += 1
+                continue
+            if run:
+                folded += self._apply(robot, steps, run)
+                robot, steps, run = None, 0, 0
+            if delta is None:
+                command.execute()
+            else:
+                robot, steps, run = command.robot, delta, 1
+        if run:
+            folded += self._apply(robot, steps, run)
+        self.folded += folded
+        return folded
+
+    def _apply(self, robot: Robot, steps: int, run: int) -> int:
+        if steps:
+            robot.move_by(steps, quiet=self.quiet)
+        return run - 1
+
+
+class ThreadedRemoteControl:
+    """
+    An invoker that executes commands on a pool of worker threads, so a slow receiver doesn't stall the client.
+    Every receiver gets its own lane (a queue of its pending commands). A lane is handed to one worker at a time,
+    so commands for the same robot run in the order they were submitted, while any idle worker can pick up
+    another robot's lane, so different robots run in parallel. After each command the worker puts the lane
+    back at the end of the line, so a busy robot doesn't hog a worker.
+    At most 'max_queue' commands can be waiting, after that press_button blocks (backpressure) until there's room
+    or the timeout expires. A command that raises is counted in 'failed', and the exception is passed to 'on_error'
+    if one was given, or kept in 'errors' otherwise. If on_error raises too, its exception is kept in 'errors'.
+    """
+
+    def __init__(self, workers: int = 4, max_queue: int = 1000, on_error=None):
+        self.on_error = on_error
+        self.errors: deque[tuple[Command, Exception]] = deque(maxlen=max_queue)
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._lanes: dict[int, deque] = {}  # id(receiver) -> its pending (command, submitted) pairs
+        self._ready = queue.SimpleQueue()  # lanes with work waiting and no worker running them
+        self._queued = 0
+        self._outstanding = 0
+        self._started = time.perf_counter()
+        self.completed = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def press_button(self, command: Command, timeout: float | None = None):
+        """Queue a command, raises queue.Full if there's no room before the timeout"""
+        if not self._slots.acquire(timeout=timeout):
+            raise queue.Full
+        # the queued command keeps its receiver alive, so the id stays unique while the lane exists
+        key = id(getattr(command, "robot", command))
+        with self._lock:
+            self._queued += 1
+            self._outstanding += 1
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = deque()
+                self._ready.put(key)
+            lane.append((command, time.perf_counter()))
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+            with self._lock:
+                command, submitted = self._lanes[key].popleft()
+                self._queued -= 1
+            self._slots.release()
+            try:
+                command.execute()
+                error = None
+            except Exception as e:
+                error = e
+            latency = time.perf_counter() - submitted
+            failed = error is not None
+            if error is not None and self.on_error is not None:
+                try:
+                    self.on_error(command, error)
+                except Exception as e:
+                    # a broken callback mustn't kill the worker, that would leave the lane and join() hanging
+                    error = e
+                else:
+                    error = None
+            if error is not None:
+                self.errors.append((command, error))
+            with self._lock:
+                if self._lanes[key]:
+                    self._ready.put(key)
+                else:
+                    del self._lanes[key]
+                self.completed += 1
+                self.failed += failed
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self._outstanding -= 1
+                if not self._outstanding:
+                    self._idle.notify_all()
+
+    @property
+    def queue_depth(self) -> int:
+        """Commands waiting to run"""
+        return self._queued
+
+    @property
+    def throughput(self) -> float:
+        """Commands completed per second since the invoker started"""
+        return self.completed / (time.perf_counter() - self._started)
+
+    @property
+    def mean_latency(self) -> float:
+        """Average seconds from press_button to the command finishing"""
+        return self.total_latency / self.completed if self.completed else 0.0
+
+    def join(self):
+        """Wait until every queued command has been executed"""
+        with self._idle:
+            self._idle.wait_for(lambda: not self._outstanding)
+
+    def shutdown(self):
+        """Finish the queued commands and stop the workers"""
+        self.join()
+        for _ in self._workers:
+            self._ready.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+class CommandJournal:
+    """
+    Records the commands sent to a robot in an append-only log, so the robot's state can be rebuilt after a restart.
+    Every command is stored as a single signed byte (its delta). Every 'snapshot_every' commands we snapshot the
+    robot's position and compact the log, so recovery only has to load the snapshot and replay a short tail.
+    Each record is flushed to the OS as soon as it's written. With 'sync' on it's also fsync'ed, so it survives
+    a crash of the whole machine, not just of our process (at the cost of a much slower record()).
+    If the journal already exists, the robot is first moved to the position recovered from it, so reopening
+    a journal picks up where it left off instead of wiping its history. Only commands for this robot can be recorded.
+    """
+
+    _snapshot = struct.Struct("<qq")  # position, log offset
+
+    def __init__(self, path: str, robot: Robot, snapshot_every: int = 10_000, sync: bool = False):
+        self.log_path = path
+        self.snapshot_path = f"{path}.snapshot"
+        self.robot = robot
+        self.snapshot_every = snapshot_every
+        self.sync = sync
+        self._since_snapshot = 0
+        if os.path.exists(self.log_path) or os.path.exists(self.snapshot_path):
+            robot.position = self.recover(path).position
+        self._log = open(self.log_path, "ab")
+        # start from a snapshot of where the robot is now (this also cleans up after a crash part way through one)
+        self.snapshot()
+
+    def record(self, command: Command):
+        """Execute the command and append it to the log"""
+        delta = getattr(command, "delta", None)
+        if delta is None:
+            raise ValueError(f"{command.__class__.__name__} can't be journaled, it has no delta")
+        if getattr(command, "robot", None) is not self.robot:
+            raise ValueError(f"{command.__class__.__name__} is for another robot, it can't go in this journal")
+        command.execute()
+        self._log.write(struct.pack("<b", delta))
+        self._log.flush()
+        if self.sync:
+            os.fsync(self._log.fileno())
+        self._since_snapshot += 1
+        if self._since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        """Save the robot's position and compact the log, it only needs to hold commands after the snapshot"""
+        self._log.flush()
+        # The snapshot points at the end of the log before we truncate it. If we crash before the second
+        # snapshot is written, recovery sees an offset past the end of the (now empty) log and replays nothing.
+        self._write_snapshot(self.robot.position, self._log.tell())
+        self._log.truncate(0)
+        self._log.seek(0)
+        self._write_snapshot(self.robot.position, 0)
+        self._since_snapshot = 0
+
+    def _write_snapshot(self, position: int, offset: int):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.snapshot_path)))
+        with os.fdopen(fd, "wb") as f:
+            f.write(self._snapshot.pack(position, offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+
+    def close(self):
+        self._log.close()
+
+    @classmethod
+    def recover(cls, path: str) -> Robot:
+        """Rebuild a robot from the newest snapshot plus the tail of the log"""
+        robot = Robot()
+        offset = 0
+        try:
+            with open(f"{path}.snapshot", "rb") as f:
+                robot.position, offset = cls._snapshot.unpack(f.read())
+        except FileNotFoundError:
+            pass
+        if not os.path.exists(path) or os.path.getsize(path) <= offset:
+            return robot
+        # No need to call execute() per command, the net change is just the sum of the deltas in the log
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as log:
+            with memoryview(log) as view:
+                robot.position += sum(view[offset:].cast("b"))
+        return robot
+
+
 def main():
     robot = Robot()
     move_forward = MoveForward(robot)
@@ -64,6 +319,23 @@ def main():
     # To move backwards, just pass the move_backward instance to the RemoteControl
     RemoteControl.press_button(move_backward)
     print(robot)
+    # If we have a lot of commands, the batch invoker folds them into a single move
+    remote = BatchRemoteControl()
+    folded = remote.press_buttons([move_forward] * 5 + [move_backward] * 2)
+    print(f"{robot} ({folded} commands folded away)")
+    # Or hand the commands to a pool of workers, the client doesn't wait for the robot to move
+    threaded_remote = ThreadedRemoteControl(workers=2)
+    threaded_remote.press_button(move_forward)
+    threaded_remote.press_button(move_forward)
+    threaded_remote.shutdown()
+    print(f"{robot} ({threaded_remote.completed} commands, {threaded_remote.mean_latency * 1000:.3f}ms avg latency)")
+    # Journal the commands, then rebuild the robot's state from the log (like we would after a restart)
+    with tempfile.TemporaryDirectory() as tmp:
+        journal = CommandJournal(os.path.join(tmp, "robot.log"), robot, snapshot_every=2)
+        for command in (move_forward, move_forward, move_backward, move_forward, move_forward):
+            journal.record(command)
+        journal.close()
+        print(f"recovered {CommandJournal.recover(journal.log_path)}")
 
 
 if __name__ == "__main__":
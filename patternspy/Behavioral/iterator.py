@@ -2,6 +2,13 @@
 # Simple but classic! The iterator pattern access the elements of an aggregate object sequentially without exposing its
 # underlying presentation. For example, we could iterate over an array, hash map, whatever.
 # We see this pattern all the time with built-in iterables and iterators in various languages.
+import bisect
+import mmap
+import os
+import sys
+import tempfile
+import timeit
+from array import array
 from collections.abc import Iterator
 
 
@@ -39,6 +46,27 @@ class BookIterator(Iterator):
         return book
 
 
+class BatchBookIterator(Iterator):
+    """
+    A fast-path iterator that hands out books a slice at a time. Slicing a list is done in C, and running off the end
+    just gives us an empty slice, so there's no per-book __getitem__ call or try/except like in BookIterator.
+    """
+
+    def __init__(self, bookshelf: "BookShelve", size: int):
+        if size < 1:
+            raise ValueError("batch size must be at least 1")
+        self._bookshelf = bookshelf
+        self.size = size
+        self.index = 0
+
+    def __next__(self) -> list[Book]:
+        batch = self._bookshelf[self.index:self.index + self.size]
+        if not batch:
+            raise StopIteration
+        self.index += len(batch)
+        return batch
+
+
 class BookShelve:
     """
     The BookShelve class is the aggregate object. It holds a collection of books, and provides an interface to iterate
@@ -46,16 +74,127 @@ class BookShelve:
 
     def __init__(self):
         self._books = []
+        # Indexes over the titles, kept up to date as books are added. The dict gives us exact lookups, and the
+        # sorted (title, position) pairs give us prefix and range queries with a binary search.
+        self._by_title: dict[str, int] = {}
+        self._sorted_titles: list[tuple[str, int]] = []
 
     def add_book(self, book: Book):
+        position = len(self._books)
         self._books.append(book)
-
-    def __getitem__(self, index: int):
+        self._by_title.setdefault(book.title, position)
+        bisect.insort(self._sorted_titles, (book.title, position))
+
+    def add_books(self, books):
+        """Add many books at once, the indexes are rebuilt once instead of updated per book"""
+        self._books.extend(books)
+        self._by_title = {}
+        for position, book in enumerate(self._books):
+            self._by_title.setdefault(book.title, position)
+        self._sorted_titles = sorted((book.title, position) for position, book in enumerate(self._books))
+
+    def find(self, title: str) -> Book | None:
+        """The first book added with exactly this title"""
+        position = self._by_title.get(title)
+        return None if position is None else self._books[position]
+
+    def find_range(self, low: str, high: str) -> list[Book]:
+        """Books with titles from low (inclusive) up to high (exclusive), in title order"""
+        start = bisect.bisect_left(self._sorted_titles, (low,))
+        end = bisect.bisect_left(self._sorted_titles, (high,))
+        return [self._books[position] for _, position in self._sorted_titles[start:end]]
+
+    def find_prefix(self, prefix: str) -> list[Book]:
+        """Books with titles starting with prefix, in title order"""
+        books = []
+        for title, position in self._sorted_titles[bisect.bisect_left(self._sorted_titles, (prefix,)):]:
+            if not title.startswith(prefix):
+                break
+            books.append(self._books[position])
+        return books
+
+    def __getitem__(self, index: int | slice):
         return self._books[index]
 
+    def __len__(self):
+        return len(self._books)
+
+    def __iter__(self):
+        return BookIterator(self)
+
+    def iter_batches(self, size: int = 1024):
+        return BatchBookIterator(self, size)
+
+
+class MappedBookShelve:
+    """
+    A BookShelve for catalogs too big to hold as a list of Book objects. The titles live back to back in a
+    memory-mapped file, and a compact array of offsets (stored next to it in '<path>.idx') tells us where each
+    title starts and ends. Books are only created when they're accessed, so it works with the same BookIterator.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._index_path = f"{path}.idx"
+        self._offsets = array("Q", [0])
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "rb") as f:
+                self._offsets = array("Q", f.read())
+        self._map = None
+
+    @classmethod
+    def from_titles(cls, path: str, titles) -> "MappedBookShelve":
+        """Write an iterable of titles to disk and open them as a shelve"""
+        offsets = array("Q", [0])
+        with open(path, "wb") as f:
+            for title in titles:
+                offsets.append(offsets[-1] + f.write(title.encode()))
+        with open(f"{path}.idx", "wb") as f:
+            offsets.tofile(f)
+        return cls(path)
+
+    def add_book(self, book: Book):
+        with open(self._path, "ab") as f:
+            self._offsets.append(self._offsets[-1] + f.write(book.title.encode()))
+        with open(self._index_path, "ab") as f:
+            if f.tell() == 0:
+                f.write(self._offsets[:1].tobytes())
+            f.write(self._offsets[-1:].tobytes())
+        # the file grew, so map it again on the next read
+        self.close()
+
+    def _titles(self):
+        if self._offsets[-1] == 0:
+            return b""  # can't map an empty file
+        if self._map is None:
+            with open(self._path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int | slice):
+        if isinstance(index, slice):
+            titles, offsets = self._titles(), self._offsets
+            return [Book(titles[offsets[i]:offsets[i + 1]].decode()) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("book index out of range")
+        return Book(self._titles()[self._offsets[index]:self._offsets[index + 1]].decode())
+
     def __iter__(self):
         return BookIterator(self)
 
+    def iter_batches(self, size: int = 1024):
+        return BatchBookIterator(self, size)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
 
 def main():
     """
@@ -73,6 +212,43 @@ def main():
     for book in bookshelf:
         print(book)
 
+    # The shelve also keeps an index of titles, so we can look books up without walking the whole collection
+    print("found", bookshelf.find("The Art of War"))
+    print("starting with 'The C'", [str(book) for book in bookshelf.find_prefix("The C")])
+
+    # A huge catalog can be kept on disk, the client code iterating over it doesn't change
+    with tempfile.TemporaryDirectory() as tmp:
+        mapped_shelf = MappedBookShelve.from_titles(os.path.join(tmp, "catalog"), (str(book) for book in bookshelf))
+        mapped_shelf.add_book(Book("Dune"))
+        for book in mapped_shelf:
+            print(book)
+        # Or a batch at a time, handy for export jobs over big shelves
+        for batch in mapped_shelf.iter_batches(4):
+            print([str(book) for book in batch])
+        mapped_shelf.close()
+
+
+def benchmark(books: int = 1_000_000, batch_size: int = 1024):
+    """Compare walking a big shelve book by book against walking it in batches"""
+    bookshelf = BookShelve()
+    bookshelf.add_books(Book(f"Book {i}") for i in range(books))
+
+    def one_at_a_time():
+        for _ in bookshelf:
+            pass
+
+    def batched():
+        for batch in bookshelf.iter_batches(batch_size):
+            for _ in batch:
+                pass
+
+    for name, run in (("BookIterator", one_at_a_time), ("BatchBookIterator", batched)):
+        seconds = min(timeit.repeat(run, number=1, repeat=3))
+        print(f"{name:>17}: {seconds:.3f}s ({books / seconds:,.0f} books/s)")
+
 
 if __name__ == "__main__":
-    main()
+    if "--benchmark" in sys.argv:
+        benchmark()
+    else:
+        main()
@@ -2,6 +2,14 @@
 # a behavioral pattern that defines an object that encapsulates how a set of objects interact.
 # I generally think of it like, I have a single object that you provide to multiple consumer objects then they each
 # interact with that single object to communicate with each other.
+import asyncio
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
 from abc import ABC, abstractmethod
 
 
@@ -15,17 +23,312 @@ class ChatRoomMediator(ABC):
         pass
 
 
-class ChatRoom(ChatRoomMediator):
+class MessageStore(ABC):
+    """
+    Where a chat room keeps its messages. Messages are stored as compact (user id, timestamp, text) records,
+    the user names are interned once in a shared table and messages are only formatted when they're displayed.
+    """
+
     def __init__(self):
+        self.user_names: list[str] = []
+        self._user_ids: dict[str, int] = {}
+
+    def user_id(self, name: str) -> int:
+        user_id = self._user_ids.get(name)
+        if user_id is None:
+            user_id = self._user_ids[name] = len(self.user_names)
+            self.user_names.append(sys.intern(name))
+        return user_id
+
+    @abstractmethod
+    def append(self, user: str, text: str):
+        pass
+
+    @abstractmethod
+    def __iter__(self):
+        """Yields the stored (user id, timestamp, text) records, oldest first"""
+        pass
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+
+class ListMessageStore(MessageStore):
+    """Keeps every message, the room's history grows without limit"""
+
+    def __init__(self):
+        super().__init__()
+        self._records = []
+
+    def append(self, user: str, text: str):
+        self._records.append((self.user_id(user), time.time(), text))
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+
+class RingBufferMessageStore(MessageStore):
+    """
+    Keeps the latest 'capacity' messages in a fixed size ring buffer, the oldest message is overwritten
+    by the newest. If a spill_path is given, overwritten messages are appended to that file instead of being lost.
+    The spill file is kept open while the store is in use, call close() when the room is done with it.
+    """
+
+    _header = struct.Struct("<dHI")  # timestamp, name length, text length
+
+    def __init__(self, capacity: int = 1000, spill_path: str | None = None):
+        super().__init__()
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self._records = [None] * capacity
+        self._next = 0
+        self._count = 0
+        self.spill_path = spill_path
+        self._spill_file = None
+
+    def append(self, user: str, text: str):
+        oldest = self._records[self._next]
+        if oldest is not None and self.spill_path:
+            self._spill(oldest)
+        self._records[self._next] = (self.user_id(user), time.time(), text)
+        self._next = (self._next + 1) % len(self._records)
+        self._count = min(self._count + 1, len(self._records))
+
+    def _spill(self, record):
+        user_id, timestamp, text = record
+        name, text = self.user_names[user_id].encode(), text.encode()
+        if self._spill_file is None:
+            self._spill_file = open(self.spill_path, "ab")
+        self._spill_file.write(self._header.pack(timestamp, len(name), len(text)) + name + text)
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def read_spilled(self):
+        """Yields the (user name, timestamp, text) of messages spilled to disk, oldest first"""
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        if self._spill_file is not None:
+            self._spill_file.flush()
+        with open(self.spill_path, "rb") as f:
+            while header := f.read(self._header.size):
+                timestamp, name_length, text_length = self._header.unpack(header)
+                name, text = f.read(name_length).decode(), f.read(text_length).decode()
+                yield name, timestamp, text
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        start = (self._next - self._count) % len(self._records)
+        for i in range(self._count):
+            yield self._records[(start + i) % len(self._records)]
+
+
+class ChatRoom(ChatRoomMediator):
+    def __init__(self, store: MessageStore | None = None):
         self.users = []
-        self.messages = []
+        self.store = store if store is not None else ListMessageStore()
+
+    @property
+    def messages(self) -> list[str]:
+        names = self.store.user_names
+        return [f"{names[user_id]}: {text}" for user_id, _, text in self.store]
 
     def display_messages(self):
         for message in self.messages:
             print(message)
 
     def send_message(self, user: "User", message: str):
-        self.messages.append(f"{user}: {message}")
+        self.store.append(str(user), message)
+
+
+class DeliveryStats:
+    """Per-user delivery counters for the AsyncChatRoom"""
+
+    def __init__(self):
+        self.delivered = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    @property
+    def mean_lag(self) -> float:
+        return self.total_lag / self.delivered if self.delivered else 0.0
+
+
+class AsyncChatRoom(ChatRoomMediator):
+    """
+    A chat room that pushes messages to its users instead of making them poll display_messages.
+    Every user that joins gets a bounded asyncio queue, and send_message fans the message out to everyone else's queue.
+    Putting on a queue never waits, so fanning out to thousands of users is just a loop over their queues.
+    When a slow user's queue is full, the policy decides what gives:
+      "drop_newest" - the new message isn't delivered to them
+      "drop_oldest" - their oldest queued message is thrown away to make room
+      "coalesce"    - their backlog is thrown away, they skip straight to the latest message
+    """
+
+    policies = ("drop_newest", "drop_oldest", "coalesce")
+
+    def __init__(self, queue_size: int = 100, policy: str = "drop_oldest", store: MessageStore | None = None):
+        if policy not in self.policies:
+            raise ValueError(f"unknown policy {policy!r}, expected one of {self.policies}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.store = store if store is not None else RingBufferMessageStore()
+        self.queues: dict[str, asyncio.Queue] = {}
+        self.stats: dict[str, DeliveryStats] = {}
+
+    def join(self, user: "User"):
+        self.queues[str(user)] = asyncio.Queue(maxsize=self.queue_size)
+        self.stats[str(user)] = DeliveryStats()
+
+    def leave(self, user: "User"):
+        self.queues.pop(str(user), None)
+        self.stats.pop(str(user), None)
+
+    def display_messages(self):
+        names = self.store.user_names
+        for user_id, _, text in self.store:
+            print(f"{names[user_id]}: {text}")
+
+    def send_message(self, user: "User", message: str):
+        sender = str(user)
+        self.store.append(sender, message)
+        item = (time.monotonic(), sender, message)
+        for name, user_queue in self.queues.items():
+            if name == sender:
+                continue
+            if user_queue.full():
+                if self.policy == "drop_newest":
+                    self.stats[name].dropped += 1
+                    continue
+                dropped = 1 if self.policy == "drop_oldest" else user_queue.qsize()
+                for _ in range(dropped):
+                    user_queue.get_nowait()
+                self.stats[name].dropped += dropped
+            user_queue.put_nowait(item)
+
+    async def receive(self, user: "User") -> str:
+        """Wait for the next message delivered to the user"""
+        sent_at, sender, message = await self.queues[str(user)].get()
+        stats = self.stats[str(user)]
+        stats.last_lag = time.monotonic() - sent_at
+        stats.max_lag = max(stats.max_lag, stats.last_lag)
+        stats.total_lag += stats.last_lag
+        stats.delivered += 1
+        return f"{sender}: {message}"
+
+
+def _shard_worker(inbox: multiprocessing.Queue, outbox: multiprocessing.Queue):
+    """The loop each shard process runs, it owns the ChatRooms for the room ids hashed onto it"""
+    rooms: dict[str, ChatRoom] = {}
+    while True:
+        request = inbox.get()
+        if request[0] == "send":
+            for room_id, user, message in request[1]:
+                room = rooms.get(room_id)
+                if room is None:
+                    room = rooms[room_id] = ChatRoom()
+                room.send_message(user, message)
+        elif request[0] == "collect":
+            room_ids = rooms if request[1] is None else [request[1]]
+            outbox.put({room_id: rooms[room_id].messages for room_id in room_ids if room_id in rooms})
+        elif request[0] == "count":
+            outbox.put(sum(len(room.store) for room in rooms.values()))
+        elif request[0] == "stop":
+            return
+
+
+class ShardedChatCluster:
+    """
+    Hosts many chat rooms across a pool of worker processes, so they can use every core on the machine.
+    Room ids are hashed onto a shard, and messages are routed to that shard's process over a multiprocessing queue.
+    Messages can be sent in batches of 'batch_size' to cut down on IPC overhead, batches are flushed before we read.
+    """
+
+    def __init__(self, workers: int | None = None, batch_size: int = 1):
+        workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self._inboxes = [multiprocessing.Queue() for _ in range(workers)]
+        self._outbox = multiprocessing.Queue()
+        self._pending: list[list[tuple[str, str, str]]] = [[] for _ in range(workers)]
+        self._processes = [
+            multiprocessing.Process(target=_shard_worker, args=(inbox, self._outbox), daemon=True)
+            for inbox in self._inboxes
+        ]
+        for process in self._processes:
+            process.start()
+
+    def _shard(self, room_id: str) -> int:
+        # a stable hash, so a room always lands on the same shard
+        return zlib.crc32(room_id.encode()) % len(self._inboxes)
+
+    def room(self, room_id: str) -> "ShardedChatRoom":
+        return ShardedChatRoom(self, room_id)
+
+    def send(self, room_id: str, user: str, message: str):
+        shard = self._shard(room_id)
+        self._pending[shard].append((room_id, user, message))
+        if len(self._pending[shard]) >= self.batch_size:
+            self._flush(shard)
+
+    def _flush(self, shard: int):
+        if self._pending[shard]:
+            self._inboxes[shard].put(("send", self._pending[shard]))
+            self._pending[shard] = []
+
+    def _ask(self, shards, request) -> list:
+        for shard in shards:
+            self._flush(shard)
+            self._inboxes[shard].put(request)
+        return [self._outbox.get() for _ in shards]
+
+    def collect(self, room_id: str | None = None) -> dict[str, list[str]]:
+        """Gather the messages of one room, or of every room on every shard"""
+        shards = range(len(self._inboxes)) if room_id is None else [self._shard(room_id)]
+        messages = {}
+        for shard_messages in self._ask(shards, ("collect", room_id)):
+            messages.update(shard_messages)
+        return messages
+
+    def message_count(self) -> int:
+        return sum(self._ask(range(len(self._inboxes)), ("count",)))
+
+    def display_messages(self):
+        for room_id, messages in sorted(self.collect().items()):
+            print(f"[{room_id}]")
+            for message in messages:
+                print(message)
+
+    def close(self):
+        for shard, inbox in enumerate(self._inboxes):
+            self._flush(shard)
+            inbox.put(("stop",))
+        for process in self._processes:
+            process.join()
+
+
+class ShardedChatRoom(ChatRoomMediator):
+    """The mediator users talk to, it forwards to the shard hosting the room"""
+
+    def __init__(self, cluster: ShardedChatCluster, room_id: str):
+        self.cluster = cluster
+        self.room_id = room_id
+
+    def display_messages(self):
+        for message in self.cluster.collect(self.room_id).get(self.room_id, []):
+            print(message)
+
+    def send_message(self, user: "User", message: str):
+        self.cluster.send(self.room_id, str(user), message)
 
 
 class User:
@@ -48,6 +351,63 @@ def main():
     kelly.send_message("What up David!")
     chat_room.display_messages()
 
+    # A long-running room can keep just its latest messages, spilling older ones to disk
+    with tempfile.TemporaryDirectory() as tmp:
+        busy_room = ChatRoom(RingBufferMessageStore(capacity=2, spill_path=os.path.join(tmp, "spill.bin")))
+        david, kelly = User("David", busy_room), User("Kelly", busy_room)
+        david.send_message("Did you see the game?")
+        kelly.send_message("No, who won?")
+        david.send_message("Nobody, it was a tie")
+        busy_room.display_messages()
+        print("spilled", [f"{name}: {text}" for name, _, text in busy_room.store.read_spilled()])
+        busy_room.store.close()
+
+
+async def async_main():
+    """With the async chat room, users get their messages pushed to them"""
+    chat_room = AsyncChatRoom(queue_size=2, policy="coalesce")
+    david = User("David", chat_room)
+    kelly = User("Kelly", chat_room)
+    chat_room.join(david)
+    chat_room.join(kelly)
+    david.send_message("Are you there?")
+    david.send_message("Hello??")
+    david.send_message("Kelly!")  # Kelly's queue is full, so she skips straight to this one
+    print("Kelly received", await chat_room.receive(kelly))
+    stats = chat_room.stats["Kelly"]
+    print(f"Kelly: {stats.delivered} delivered, {stats.dropped} dropped, {stats.max_lag * 1000:.3f}ms max lag")
+
+
+def sharded_main():
+    """Rooms hosted on a cluster of processes look just like a regular ChatRoom to the users"""
+    cluster = ShardedChatCluster(workers=2)
+    david = User("David", cluster.room("general"))
+    kelly = User("Kelly", cluster.room("random"))
+    david.send_message("Anyone here?")
+    kelly.send_message("Over here!")
+    cluster.display_messages()
+    cluster.close()
+
+
+def benchmark(messages: int = 200_000, rooms: int = 1000, batch_size: int = 256):
+    """Messages per second through the sharded cluster as we add worker processes"""
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        cluster = ShardedChatCluster(workers=workers, batch_size=batch_size)
+        start = time.perf_counter()
+        for i in range(messages):
+            cluster.send(f"room-{i % rooms}", f"user-{i % 50}", "hello")
+        delivered = cluster.message_count()
+        seconds = time.perf_counter() - start
+        cluster.close()
+        print(f"{workers:>3} workers: {delivered / seconds:,.0f} messages/s")
+        workers *= 2
+
 
 if __name__ == "__main__":
-    main()
+    if "--benchmark" in sys.argv:
+        benchmark()
+    else:
+        main()
+        asyncio.run(async_main())
+        sharded_main()
@@ -1,31 +1,648 @@
 # Observer pattern
+import bisect
+import itertools
+import queue
+import random
+import threading
+import time
+import weakref
 from abc import ABC, abstractmethod
+from array import array
+from collections import deque
+from typing import NamedTuple
 
 
 # a behavioral design pattern that allows object(s) to subscribe to changes in state of another object
 # The 'subject' maintains a list of 'observers' and notifies them, usually through a method call, of state changes
 
+class DispatchPolicy(ABC):
+    """
+    Decides when a Stock notifies its observers of a price change.
+    Keeps count of the ticks it saw and the observer calls it made, so we can see how many calls were saved.
+    """
+
+    def __init__(self):
+        self.ticks = 0
+        self.calls = 0
+        self.possible_calls = 0
+
+    @property
+    def saved_calls(self) -> int:
+        """How many observer calls we skipped compared to notifying every observer on every tick"""
+        return self.possible_calls - self.calls
+
+    def on_price_change(self, stock: "Stock"):
+        self.ticks += 1
+        self.possible_calls += stock.observer_count()
+
+    def flush(self, stock: "Stock"):
+        """Deliver anything that's still waiting on the current window"""
+        pass
+
+
+class ImmediateDispatch(DispatchPolicy):
+    """Notify every observer on every tick, the classic observer pattern"""
+
+    def on_price_change(self, stock: "Stock"):
+        super().on_price_change(stock)
+        self.calls += stock.notify()
+
+
+class WindowedDispatch(DispatchPolicy):
+    """
+    Delivers at most once per 'window' seconds. A tick after the window has closed is delivered straight away.
+    A tick inside the window is held back, and a timer delivers it when the window closes, so observers still
+    hear about the last tick if the feed goes quiet. flush() delivers early, close() cancels a pending timer.
+    """
+
+    def __init__(self, window: float, clock=time.monotonic):
+        super().__init__()
+        self.window = window
+        self.clock = clock
+        self._last_flush = None
+        self._timer = None
+        # the timer flushes from its own thread, the lock keeps it from delivering at the same time as a tick
+        self._lock = threading.RLock()
+
+    @abstractmethod
+    def _hold(self, stock: "Stock"):
+        """Keep the tick until the next delivery"""
+        pass
+
+    @abstractmethod
+    def _deliver(self, stock: "Stock"):
+        """Notify the observers of whatever was held"""
+        pass
+
+    def on_price_change(self, stock: "Stock"):
+        with self._lock:
+            super().on_price_change(stock)
+            self._hold(stock)
+            elapsed = None if self._last_flush is None else self.clock() - self._last_flush
+            if elapsed is None or elapsed >= self.window:
+                self.flush(stock)
+            elif self._timer is None:
+                self._timer = threading.Timer(self.window - elapsed, self.flush, args=(stock,))
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self, stock: "Stock"):
+        with self._lock:
+            self.close()
+            self._deliver(stock)
+            self._last_flush = self.clock()
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+
+class CoalescingDispatch(WindowedDispatch):
+    """Notify at most once per 'window' seconds, with the latest price"""
+
+    def __init__(self, window: float, clock=time.monotonic):
+        super().__init__(window, clock)
+        self._pending = False
+
+    def _hold(self, stock: "Stock"):
+        self._pending = True
+
+    def _deliver(self, stock: "Stock"):
+        if self._pending:
+            self.calls += stock.notify()
+            self._pending = False
+
+
+class BatchingDispatch(WindowedDispatch):
+    """
+    Like CoalescingDispatch, but instead of just the latest price, observers get every (timestamp, price) tick
+    from the window in one call to notify_batch.
+    """
+
+    def __init__(self, window: float, clock=time.monotonic):
+        super().__init__(window, clock)
+        self._ticks = []
+
+    def _hold(self, stock: "Stock"):
+        self._ticks.append((self.clock(), stock.price))
+
+    def _deliver(self, stock: "Stock"):
+        if self._ticks:
+            ticks, self._ticks = self._ticks, []
+            observers = stock.interested_observers()
+            for observer in observers:
+                observer.notify_batch(stock, ticks)
+            self.calls += len(observers)
+
+
+class PriceSnapshot(NamedTuple):
+    """The state of a stock at the time of a tick, handed to observers that are notified after the price moved on"""
+
+    symbol: str
+    price: float
+
+
+class _Lane:
+    """The ticks waiting for one observer, 'scheduled' while it's queued for, or running on, a worker"""
+
+    __slots__ = ("ref", "ticks", "scheduled")
+
+    def __init__(self, ref: weakref.ref):
+        self.ref = ref
+        self.ticks = deque()
+        self.scheduled = False
+
+
+class ConcurrentDispatch(DispatchPolicy):
+    """
+    Delivers notifications on a pool of threads, so a slow observer can't hold up the price feed.
+    change_price returns as soon as the ticks are queued. Every observer has its own lane of waiting ticks, and a lane
+    is only handed to a worker once the observer's previous call has returned. So each observer gets its ticks in
+    order and never two calls at once, while different observers are notified in parallel.
+    A call that raises is counted in 'errors'. The timeout starts when the call starts running, not while it's
+    waiting for a thread. A call still running after 'timeout' seconds is counted as 'late', and a watchdog starts
+    a replacement worker so the other observers keep the whole pool. The slow observer's lane waits until its
+    call returns, and then that thread retires if the pool is back to full strength.
+    Lanes only hold weak references, so they don't keep an observer alive. Ticks for an observer that was garbage
+    collected before they ran are counted in 'dropped' instead of 'delivered'.
+    """
+
+    def __init__(self, workers: int = 8, timeout: float = 1.0):
+        super().__init__()
+        self.workers = workers
+        self.timeout = timeout
+        self.delivered = 0
+        self.dropped = 0
+        self.late = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._lanes: dict[int, _Lane] = {}  # keyed by id(observer)
+        self._ready = queue.SimpleQueue()  # ids of lanes waiting for a worker
+        self._dead = queue.SimpleQueue()  # ids of observers that were garbage collected
+        self._outstanding = 0
+        self._running: dict[threading.Thread, float] = {}  # worker -> when its current call started
+        self._stuck: set[threading.Thread] = set()
+        self._active = 0
+        self._closed = threading.Event()
+        with self._lock:
+            for _ in range(workers):
+                self._start_worker()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _start_worker(self):
+        self._active += 1
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def on_price_change(self, stock: "Stock"):
+        super().on_price_change(stock)
+        observers = stock.interested_observers()
+        self.calls += len(observers)
+        snapshot = PriceSnapshot(stock.symbol, stock.price)
+        with self._lock:
+            self._prune()
+            for observer in observers:
+                key = id(observer)
+                lane = self._lanes.get(key)
+                if lane is None or lane.ref() is not observer:
+                    new_lane = _Lane(weakref.ref(observer, lambda _, key=key: self._dead.put(key)))
+                    if lane is not None:
+                        # the id was reused by a new observer, the old one's ticks go nowhere
+                        self._outstanding -= len(lane.ticks)
+                        self.dropped += len(lane.ticks)
+                        new_lane.scheduled = lane.scheduled
+                    lane = self._lanes[key] = new_lane
+                lane.ticks.append(snapshot)
+                self._outstanding += 1
+                if not lane.scheduled:
+                    lane.scheduled = True
+                    self._ready.put(key)
+
+    def _prune(self):
+        while not self._dead.empty():
+            key = self._dead.get()
+            lane = self._lanes.get(key)
+            if lane is not None and lane.ref() is None and not lane.scheduled:
+                del self._lanes[key]
+
+    def _work(self):
+        worker = threading.current_thread()
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+            with self._lock:
+                lane = self._lanes[key]
+                snapshot = lane.ticks.popleft()
+                observer = lane.ref()
+                self._running[worker] = time.monotonic()
+            failed = False
+            called = observer is not None
+            try:
+                if called:
+                    observer.notify(snapshot)
+            except Exception:
+                failed = True
+            observer = None
+            with self._lock:
+                started = self._running.pop(worker)
+                stuck = worker in self._stuck
+                self._stuck.discard(worker)
+                late = stuck or time.monotonic() - started > self.timeout
+                if not called:
+                    self.dropped += 1
+                elif failed:
+                    self.errors += 1
+                elif late:
+                    self.late += 1
+                else:
+                    self.delivered += 1
+                lane = self._lanes[key]
+                if lane.ref() is None:
+                    self._outstanding -= len(lane.ticks)
+                    self.dropped += len(lane.ticks)
+                    lane.ticks.clear()
+                if lane.ticks:
+                    self._ready.put(key)
+                else:
+                    lane.scheduled = False
+                    if lane.ref() is None:
+                        del self._lanes[key]
+                self._outstanding -= 1
+                if not self._outstanding:
+                    self._idle.notify_all()
+                if stuck:
+                    # a replacement took over while we were stuck, only stay if the pool is short
+                    if self._active >= self.workers:
+                        return
+                    self._active += 1
+
+    def _watch(self):
+        while not self._closed.wait(self.timeout / 4):
+            now = time.monotonic()
+            with self._lock:
+                for worker, started in self._running.items():
+                    if worker not in self._stuck and now - started > self.timeout:
+                        self._stuck.add(worker)
+                        self._active -= 1
+                        self._start_worker()
+
+    def join(self):
+        """Wait until every queued notification was delivered (late ones included)"""
+        with self._idle:
+            self._idle.wait_for(lambda: not self._outstanding)
+
+    def close(self):
+        self.join()
+        self._closed.set()
+        with self._lock:
+            for _ in range(self._active):
+                self._ready.put(None)
+
+
+class ObserverRegistry:
+    """
+    The observers attached to a stock. It's an insertion-ordered dict keyed by id(observer), so attaching and
+    detaching are O(1). Observers are only held by weak reference, once nothing else refers to an observer
+    it's removed from the registry automatically instead of being kept alive by the stock.
+    """
+
+    def __init__(self):
+        self._refs: dict[int, weakref.ref] = {}
+
+    def add(self, observer: "Subscriber"):
+        key = id(observer)
+        refs = self._refs
+        if key in refs and refs[key]() is observer:
+            return
+
+        def prune(ref, key=key):
+            if refs.get(key) is ref:
+                del refs[key]
+
+        refs[key] = weakref.ref(observer, prune)
+
+    def remove(self, observer: "Subscriber"):
+        if observer not in self:
+            raise ValueError("observer is not attached")
+        del self._refs[id(observer)]
+
+    def __contains__(self, observer: "Subscriber"):
+        ref = self._refs.get(id(observer))
+        return ref is not None and ref() is observer
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __iter__(self):
+        for ref in list(self._refs.values()):
+            observer = ref()
+            if observer is not None:
+                yield observer
+
+
+class _BandNode:
+    __slots__ = ("key", "high", "ref", "priority", "left", "right", "max_high")
+
+    def __init__(self, key: tuple[float, int], high: float, ref: weakref.ref):
+        self.key = key
+        self.high = high
+        self.ref = ref
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.max_high = high
+
+
+class BandTree:
+    """
+    An interval tree for band subscriptions. It's a treap (a binary search tree kept balanced by random priorities)
+    ordered by the low end of the bands, where every node also knows the highest high end in its subtree.
+    To find the bands containing a price, we skip every subtree whose highest high end is below the price, and
+    everything to the right of a node whose low end is above it. Adding and removing a band are O(log n).
+    """
+
+    def __init__(self):
+        self.root = None
+        self._length = 0
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return self._length
+
+    def add(self, low: float, high: float, ref: weakref.ref) -> tuple[float, int]:
+        """Add a band, returns the key to remove it with"""
+        node = _BandNode((low, next(self._sequence)), high, ref)
+        self.root = self._insert(self.root, node)
+        self._length += 1
+        return node.key
+
+    def remove(self, key: tuple[float, int]):
+        self.root = self._remove(self.root, key)
+        self._length -= 1
+
+    def stab(self, price: float) -> list[weakref.ref]:
+        """The references of every band with low <= price <= high"""
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None or node.max_high < price:
+                continue
+            stack.append(node.left)
+            if node.key[0] <= price:
+                if price <= node.high:
+                    found.append(node.ref)
+                stack.append(node.right)
+        return found
+
+    @staticmethod
+    def _update(node: _BandNode):
+        node.max_high = node.high
+        if node.left is not None and node.left.max_high > node.max_high:
+            node.max_high = node.left.max_high
+        if node.right is not None and node.right.max_high > node.max_high:
+            node.max_high = node.right.max_high
+
+    def _rotate_right(self, node: _BandNode) -> _BandNode:
+        left = node.left
+        node.left, left.right = left.right, node
+        self._update(node)
+        self._update(left)
+        return left
+
+    def _rotate_left(self, node: _BandNode) -> _BandNode:
+        right = node.right
+        node.right, right.left = right.left, node
+        self._update(node)
+        self._update(right)
+        return right
+
+    def _insert(self, node: _BandNode | None, new: _BandNode) -> _BandNode:
+        if node is None:
+            return new
+        if new.key < node.key:
+            node.left = self._insert(node.left, new)
+            if node.left.priority > node.priority:
+                return self._rotate_right(node)
+        else:
+            node.right = self._insert(node.right, new)
+            if node.right.priority > node.priority:
+                return self._rotate_left(node)
+        self._update(node)
+        return node
+
+    def _remove(self, node: _BandNode | None, key: tuple[float, int]) -> _BandNode | None:
+        if node is None:
+            raise KeyError(key)
+        if key < node.key:
+            node.left = self._remove(node.left, key)
+        elif key > node.key:
+            node.right = self._remove(node.right, key)
+        elif node.left is None:
+            return node.right
+        elif node.right is None:
+            return node.left
+        elif node.left.priority > node.right.priority:
+            node = self._rotate_right(node)
+            node.right = self._remove(node.right, key)
+        else:
+            node = self._rotate_left(node)
+            node.left = self._remove(node.left, key)
+        self._update(node)
+        return node
+
+
+class PriceIndex:
+    """
+    Observers that only want to hear about some prices, kept sorted by their thresholds:
+      above=x      - notify when the price is above x
+      below=x      - notify when the price is below x
+      band=(l, h)  - notify when l <= price <= h
+    Finding who's interested in a price is then a binary search, rather than asking every observer.
+    Bands go in a BandTree (an interval tree), so finding the bands containing a price doesn't look at the others.
+    Like the ObserverRegistry, observers are held by weak reference and removed once they're garbage collected.
+    """
+
+    def __init__(self):
+        self._above_prices, self._above = [], []
+        self._below_prices, self._below = [], []
+        self._bands = BandTree()
+        # id(observer) -> (weak reference to it, the conditions it was added with)
+        self._conditions: dict[int, tuple[weakref.ref, list[tuple[str, float]]]] = {}
+
+    def add(self, observer: "Subscriber", above: float | None = None, below: float | None = None,
+            band: tuple[float, float] | None = None):
+        if (above is not None) + (below is not None) + (band is not None) != 1:
+            raise ValueError("expected exactly one of above, below or band")
+        if observer not in self:
+            self._conditions[id(observer)] = (weakref.ref(observer, lambda _, key=id(observer): self._prune(key)), [])
+        ref, conditions = self._conditions[id(observer)]
+        if band is not None:
+            conditions.append(("band", self._bands.add(band[0], band[1], ref)))
+            return
+        if above is not None:
+            kind, key, prices, observers = "above", above, self._above_prices, self._above
+        else:
+            kind, key, prices, observers = "below", below, self._below_prices, self._below
+        position = bisect.bisect_right(prices, key)
+        prices.insert(position, key)
+        observers.insert(position, ref)
+        conditions.append((kind, key))
+
+    def remove(self, observer: "Subscriber"):
+        if observer not in self:
+            raise ValueError("observer is not attached")
+        self._remove(id(observer))
+
+    def _prune(self, key: int):
+        if key in self._conditions and self._conditions[key][0]() is None:
+            self._remove(key)
+
+    def _remove(self, key: int):
+        ref, conditions = self._conditions.pop(key)
+        for kind, key in conditions:
+            if kind == "band":
+                self._bands.remove(key)
+                continue
+            prices, observers = (self._above_prices, self._above) if kind == "above" else \
+                (self._below_prices, self._below)
+            for position in range(bisect.bisect_left(prices, key), bisect.bisect_right(prices, key)):
+                if observers[position] is ref:
+                    del prices[position], observers[position]
+                    break
+
+    def __contains__(self, observer: "Subscriber"):
+        entry = self._conditions.get(id(observer))
+        return entry is not None and entry[0]() is observer
+
+    def __len__(self):
+        return len(self._above) + len(self._below) + len(self._bands)
+
+    def match(self, price: float) -> list["Subscriber"]:
+        matches = self._above[:bisect.bisect_left(self._above_prices, price)]
+        matches += self._below[bisect.bisect_right(self._below_prices, price):]
+        matches += self._bands.stab(price)
+        # an observer attached with several conditions is still only notified once
+        observers = (ref() for ref in dict.fromkeys(matches))
+        return [observer for observer in observers if observer is not None]
+
+
+def _unique(observers) -> list:
+    """Drop repeats (e.g. an observer attached both plainly and with a condition), keeping the first of each"""
+    return list({id(observer): observer for observer in reversed(observers)}.values())[::-1]
+
+
 class Stock:
     """Subject class that maintains a list of observers and notifies them of state changes."""
 
-    def __init__(self, symbol, price):
+    def __init__(self, symbol, price, dispatch: DispatchPolicy | None = None):
         self.symbol = symbol
         self.price = price
-        self.observers = []
+        self.observers = ObserverRegistry()
+        self.conditions = PriceIndex()
+        self.dispatch = dispatch if dispatch is not None else ImmediateDispatch()
 
     def change_price(self, price):
         self.price = price
-        self.notify()
+        self.dispatch.on_price_change(self)
+
+    def flush(self):
+        self.dispatch.flush(self)
 
-    def attach(self, observer):
-        self.observers.append(observer)
+    def attach(self, observer, above: float | None = None, below: float | None = None,
+               band: tuple[float, float] | None = None):
+        """Attach an observer, optionally only notifying it of prices above, below or within a band"""
+        if above is None and below is None and band is None:
+            self.observers.add(observer)
+        else:
+            self.conditions.add(observer, above=above, below=below, band=band)
 
     def detach(self, observer):
-        self.observers.remove(observer)
+        """Remove the observer, both its plain and its conditional subscriptions"""
+        if observer not in self.conditions and observer not in self.observers:
+            raise ValueError("observer is not attached")
+        if observer in self.conditions:
+            self.conditions.remove(observer)
+        if observer in self.observers:
+            self.observers.remove(observer)
+
+    def observer_count(self) -> int:
+        return len(self.observers) + len(self.conditions)
 
-    def notify(self):
-        for observer in self.observers:
+    def interested_observers(self) -> list:
+        """The observers that want to hear about the current price"""
+        if not len(self.conditions):
+            return list(self.observers)
+        return _unique(list(self.observers) + self.conditions.match(self.price))
+
+    def notify(self) -> int:
+        observers = self.interested_observers()
+        for observer in observers:
             observer.notify(self)
+        return len(observers)
+
+
+class StockBook:
+    """
+    Tracks the prices of many symbols in one object, instead of one Stock object per symbol.
+    Prices are kept in a flat array indexed by symbol, and ticks are applied in batches of (symbol index, price).
+    Only the last tick per symbol in a batch counts, and only symbols with observers are looked at, by intersecting
+    the batch's symbols with the watched ones. Observers use the same attach conditions as Stock, and are notified
+    through the Subscriber interface with a PriceSnapshot.
+    """
+
+    def __init__(self, symbols, prices):
+        self.symbols = list(symbols)
+        self.prices = array("d", prices)
+        if len(self.symbols) != len(self.prices):
+            raise ValueError("expected a price for every symbol")
+        self._indexes = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self._observers: dict[int, ObserverRegistry] = {}
+        self._conditions: dict[int, PriceIndex] = {}
+
+    def index(self, symbol: str) -> int:
+        return self._indexes[symbol]
+
+    def __getitem__(self, symbol: str) -> float:
+        return self.prices[self._indexes[symbol]]
+
+    def attach(self, symbol: str, observer: "Subscriber", above: float | None = None, below: float | None = None,
+               band: tuple[float, float] | None = None):
+        i = self._indexes[symbol]
+        if above is None and below is None and band is None:
+            self._observers.setdefault(i, ObserverRegistry()).add(observer)
+        else:
+            self._conditions.setdefault(i, PriceIndex()).add(observer, above=above, below=below, band=band)
+
+    def detach(self, symbol: str, observer: "Subscriber"):
+        i = self._indexes[symbol]
+        conditional = i in self._conditions and observer in self._conditions[i]
+        plain = i in self._observers and observer in self._observers[i]
+        if not conditional and not plain:
+            raise ValueError("observer is not attached")
+        if conditional:
+            self._conditions[i].remove(observer)
+        if plain:
+            self._observers[i].remove(observer)
+
+    def apply_ticks(self, indices, prices) -> int:
+        """Apply a batch of ticks, returns how many notifications were sent"""
+        latest = dict(zip(indices, prices))
+        for i, price in latest.items():
+            self.prices[i] = price
+        notified = 0
+        for i in latest.keys() & (self._observers.keys() | self._conditions.keys()):
+            snapshot = PriceSnapshot(self.symbols[i], latest[i])
+            observers = list(self._observers.get(i, ()))
+            if i in self._conditions:
+                observers = _unique(observers + self._conditions[i].match(snapshot.price))
+            for observer in observers:
+                observer.notify(snapshot)
+            notified += len(observers)
+        return notified
 
 
 class Subscriber(ABC):
@@ -35,6 +652,10 @@ class Subscriber(ABC):
     def notify(self, stock: Stock):
         pass
 
+    def notify_batch(self, stock: Stock, ticks: list[tuple[float, float]]):
+        """Called with every (timestamp, price) tick of a window when the stock batches its notifications"""
+        self.notify(stock)
+
 
 class Investor(Subscriber):
     """Observer that subscribes to subject state changes"""
@@ -62,6 +683,35 @@ def main():
     stock.detach(investor1)
     stock.change_price(998)
 
+    # Observers can also ask to only hear about some prices, like an alert when the price drops below 900
+    stock.attach(investor1, below=900)
+    stock.change_price(950)
+    stock.change_price(850)
+    stock.detach(investor1)
+
+    # A busy stock can coalesce its ticks, so observers hear about the latest price at most once per window
+    busy_stock = Stock('NVDA', 100, CoalescingDispatch(window=60))
+    busy_stock.attach(investor1)
+    for price in range(101, 111):
+        busy_stock.change_price(price)
+    busy_stock.flush()
+    print(f'{busy_stock.dispatch.ticks} ticks, {busy_stock.dispatch.saved_calls} notifications saved')
+
+    # Or deliver notifications in the background, change_price doesn't wait on the observers
+    fast_stock = Stock('TSLA', 250, ConcurrentDispatch(workers=2, timeout=0.5))
+    fast_stock.attach(investor2)
+    fast_stock.change_price(260)
+    fast_stock.change_price(270)
+    fast_stock.dispatch.close()
+    print(f'{fast_stock.dispatch.delivered} notifications delivered in the background')
+
+    # When we follow lots of symbols, a StockBook keeps them all in one place and takes ticks in batches
+    book = StockBook(['AAPL', 'MSFT', 'GOOG'], [190, 410, 170])
+    book.attach('MSFT', investor1, above=420)
+    book.attach('GOOG', investor2)
+    book.apply_ticks([book.index('MSFT'), book.index('AAPL'), book.index('MSFT')], [415, 191, 425])
+    book.apply_ticks([book.index('GOOG')], [172])
+
 
 if __name__ == '__main__':
     main()
@@ -1,6 +1,17 @@
 # Chain of Responsibility Pattern
 # Used to pass requests along a chain of handlers until a suitable handler is found to process the request.
 # useful when we need to build a fallback mechanism for a request, or we have a hierarchy of handlers.
+import random
+import sys
+import threading
+import time
+import weakref
+from array import array
+from bisect import bisect_left
+from functools import partial
+from itertools import accumulate
+from typing import NamedTuple
+
 
 class BaseAccount:
     def __init__(self, balance: float = 0):
@@ -36,6 +47,178 @@ class PayPalAccount(BaseAccount):
     pass
 
 
+class PaymentResult(NamedTuple):
+    """What happened to a payment, account is None if none of the accounts could pay"""
+
+    amount: float
+    account: BaseAccount | None
+    hops: int
+    trace: list[str] | None = None
+
+    @property
+    def paid(self) -> bool:
+        return self.account is not None
+
+
+class _MaxTree:
+    """A segment tree over the balances, finds the first account that can cover an amount in O(log n)"""
+
+    def __init__(self, balances: list[float]):
+        self.size = 1
+        while self.size < len(balances):
+            self.size *= 2
+        self.tree = [float("-inf")] * (2 * self.size)
+        self.tree[self.size:self.size + len(balances)] = balances
+        for node in range(self.size - 1, 0, -1):
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def first_at_least(self, amount: float) -> int:
+        if self.tree[1] < amount:
+            return -1
+        node = 1
+        while node < self.size:
+            node = 2 * node if self.tree[2 * node] >= amount else 2 * node + 1
+        return node - self.size
+
+    def subtract(self, index: int, amount: float):
+        node = index + self.size
+        self.tree[node] -= amount
+        node //= 2
+        while node:
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+            node //= 2
+
+
+class CompiledChain:
+    """
+    The chain of accounts starting at 'head', flattened into a list. Paying is then one loop over the list,
+    rather than a recursive call per account, so long chains don't hit the recursion limit.
+    Instead of printing, pay returns a PaymentResult. With trace on, the result includes the messages
+    BaseAccount.pay would have printed. The chain is compiled once, relink the accounts and compile a new one.
+    """
+
+    def __init__(self, head: BaseAccount, trace: bool = False):
+        self.accounts: list[BaseAccount] = []
+        seen = set()
+        account = head
+        while account is not None:
+            if id(account) in seen:
+                raise ValueError("the chain of accounts loops back on itself")
+            seen.add(id(account))
+            self.accounts.append(account)
+            account = account.successor
+        self.names = [account.__class__.__name__ for account in self.accounts]
+        self.trace = trace
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def pay(self, amount: float) -> PaymentResult:
+        for hop, account in enumerate(self.accounts):
+            if account.can_pay(amount):
+                return PaymentResult(amount, account, hop + 1, self._trace(amount, hop) if self.trace else None)
+        return PaymentResult(amount, None, len(self.accounts), self._trace(amount, None) if self.trace else None)
+
+    def route_batch(self, amounts, debit: bool = False) -> array:
+        """
+        Work out which account pays each of the amounts. Returns an array with, for every payment, the index of the
+        paying account in self.accounts, or -1 if none of them could pay. Like BaseAccount.can_pay, an account pays
+        if its balance covers the amount.
+
+        The first account that can pay is the first one where the running maximum of the balances covers the amount,
+        and that running maximum only goes up, so each payment is a binary search over it.
+        With debit on, every payment is taken off the paying account's balance before routing the next payment,
+        and the new balances are written back to the accounts at the end.
+        """
+        balances = [account.balance for account in self.accounts]
+        if not debit:
+            running_max = list(accumulate(balances, max))
+            routes = array("q", map(partial(bisect_left, running_max), amounts))
+            for i, route in enumerate(routes):
+                if route == len(running_max):
+                    routes[i] = -1
+            return routes
+
+        tree = _MaxTree(balances)
+        routes = array("q")
+        for amount in amounts:
+            route = tree.first_at_least(amount)
+            if route >= 0:
+                tree.subtract(route, amount)
+            routes.append(route)
+        for i, account in enumerate(self.accounts):
+            account.balance = tree.tree[tree.size + i]
+        return routes
+
+    def _trace(self, amount: float, paid_by: int | None) -> list[str]:
+        failed = len(self.names) if paid_by is None else paid_by
+        trace = [
+            f"Can't pay using {self.names[i]}. Passing request to {self.names[i + 1]}"
+            for i in range(min(failed, len(self.names) - 1))
+        ]
+        if paid_by is None:
+            trace.append(f"None of the accounts have enough balance to pay {amount}")
+        else:
+            trace.append(f"Paid {amount} using {self.names[paid_by]}")
+        return trace
+
+
+# one lock per account, shared by every chain it's in, so paying through different chains is still safe
+_account_locks: "weakref.WeakKeyDictionary[BaseAccount, threading.Lock]" = weakref.WeakKeyDictionary()
+_account_locks_guard = threading.Lock()
+
+
+def account_lock(account: BaseAccount) -> threading.Lock:
+    with _account_locks_guard:
+        lock = _account_locks.get(account)
+        if lock is None:
+            lock = _account_locks[account] = threading.Lock()
+        return lock
+
+
+class ConcurrentChain(CompiledChain):
+    """
+    A compiled chain that's safe to pay from many threads at once, and actually takes payments off the balances.
+    Each account has its own lock (the same one in every chain the account is part of), checking the balance
+    and debiting it happen together while holding it, so two payments can never both pass the check and overdraw it.
+    Balances only ever go down, so an account that can't cover the amount when we look without the lock
+    won't be able to once we hold it either. Those accounts are skipped without touching their lock.
+    """
+
+    def __init__(self, head: BaseAccount, trace: bool = False):
+        super().__init__(head, trace)
+        self.locks = [account_lock(account) for account in self.accounts]
+
+    def pay(self, amount: float) -> PaymentResult:
+        for hop, account in enumerate(self.accounts):
+            if account.balance < amount:
+                continue
+            with self.locks[hop]:
+                if account.balance < amount:
+                    continue
+                account.balance -= amount
+            return PaymentResult(amount, account, hop + 1, self._trace(amount, hop) if self.trace else None)
+        return PaymentResult(amount, None, len(self.accounts), self._trace(amount, None) if self.trace else None)
+
+    def route_batch(self, amounts, debit: bool = False) -> array:
+        """
+        Like CompiledChain.route_batch. With debit on, every account stays locked for the whole batch, so payments
+        made from other threads wait for the batch to write back its balances instead of being overwritten by it.
+        The locks are always taken in the same order (by id), whatever the chain, and pay only ever holds one,
+        so batches on chains sharing accounts can't deadlock each other.
+        """
+        if not debit:
+            return super().route_batch(amounts)
+        locks = sorted({id(lock): lock for lock in self.locks}.items())
+        for _, lock in locks:
+            lock.acquire()
+        try:
+            return super().route_batch(amounts, debit=True)
+        finally:
+            for _, lock in reversed(locks):
+                lock.release()
+
+
 def main():
     """
     Say we have a client account, first we try to pay with the account credit, if it doesn't have enough balance,
@@ -48,6 +231,50 @@ def main():
     paypal.set_next(bank)
     account.pay(250)
 
+    # Compiling the chain walks it in a single loop, and gives us back the result instead of printing it
+    chain = CompiledChain(account, trace=True)
+    result = chain.pay(250)
+    print(f"paid by {result.account.__class__.__name__} after {result.hops} hops")
+    print("\n".join(result.trace))
+
+    # Lots of payments can be routed in one go, here each payment is also taken off the balance that paid it
+    routes = chain.route_batch([80, 80, 150, 300], debit=True)
+    print("paid by", [chain.names[route] if route >= 0 else None for route in routes])
+
+
+def benchmark(threads: int = 8, payments: int = 50_000, accounts: int = 10):
+    """Pay from many threads at once, and check that no account was overdrawn or lost track of a payment"""
+    head = account = BaseAccount(random.uniform(0, 100_000))
+    for _ in range(accounts - 1):
+        account = account.set_next(BaseAccount(random.uniform(0, 100_000)))
+    chain = ConcurrentChain(head)
+    opening_total = sum(account.balance for account in chain.accounts)
+    paid = [0.0] * threads
+
+    def pay(worker: int):
+        for _ in range(payments):
+            result = chain.pay(random.uniform(1, 100))
+            if result.paid:
+                paid[worker] += result.amount
+
+    workers = [threading.Thread(target=pay, args=(worker,)) for worker in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - start
+
+    lowest = min(account.balance for account in chain.accounts)
+    unaccounted = opening_total - sum(account.balance for account in chain.accounts) - sum(paid)
+    print(f"{threads * payments / seconds:,.0f} payments/s with {threads} threads")
+    print(f"lowest balance {lowest:.2f}, unaccounted {unaccounted:.6f}")
+    assert lowest >= 0, "an account was overdrawn"
+    assert abs(unaccounted) < 1e-6 * opening_total, "a payment was lost"
+
 
 if __name__ == "__main__":
-    main()
+    if "--benchmark" in sys.argv:
+        benchmark()
+    else:
+        main()
@@ -3,7 +3,13 @@
 # relatively simple pattern that allows us to change the implementation/behavior of an object at runtime.
 # We store different implementations in the object and call the methods of the implementation that we want to use.
 
+import io
+import operator
+import os
+import sys
+import timeit
 from abc import ABC, abstractmethod
+from contextlib import redirect_stdout
 
 
 class LaptopState(ABC):
@@ -54,21 +60,141 @@ class LaptopOn(LaptopState):
         print("Typing words")
 
 
+# The events a laptop responds to, in the order of the columns of the transition table
+EVENTS = ("power_button", "volume_up_button", "volume_down_button", "type_words")
+POWER_BUTTON, VOLUME_UP_BUTTON, VOLUME_DOWN_BUTTON, TYPE_WORDS = range(len(EVENTS))
+
+
+class StateMachine:
+    """
+    Compiles state classes into a transition table, so handling an event is a single list lookup plus its action.
+    There's one (flyweight) instance of every state. The table is flat, row 'state * len(events) + event' holds
+    the action (that state's handler for the event, bound to the flyweight) and the state it moves to.
+    We only know where a handler leads once it has returned (methods that don't return a state leave it unchanged),
+    so a row's next state is filled in the first time it fires. Nothing is run when the machine is built.
+    """
+
+    def __init__(self, state_classes: list[type[LaptopState]], events: tuple[str, ...] = EVENTS):
+        self.events = events
+        self.states = [state_class() for state_class in state_classes]
+        self.state_ids = {state_class: i for i, state_class in enumerate(state_classes)}
+        self.actions = [getattr(state, event) for state in self.states for event in events]
+        self.next_states: list[int | None] = [None] * len(self.actions)
+        self._outcomes: list[tuple[int, str]] | None = None
+
+    def fire(self, state: int, event: int) -> int:
+        """Run the event's action, returns the id of the next state"""
+        row = state * len(self.events) + event
+        result = self.actions[row]()
+        next_state = self.next_states[row]
+        if next_state is None:
+            next_state = self.next_states[row] = self._next_id(result, state)
+        return next_state
+
+    def _next_id(self, result, state: int) -> int:
+        return self.state_ids[type(result)] if isinstance(result, LaptopState) else state
+
+    def outcomes(self) -> list[tuple[int, str]]:
+        """
+        The (next state, message) of every row, for simulating devices without running their actions (see Fleet).
+        Finding them means running every action once with its output captured. That's a dry run with whatever
+        side effects the handlers have, and sys.stdout is swapped while it runs, so it's only done when asked for.
+        """
+        if self._outcomes is None:
+            outcomes = []
+            for row, action in enumerate(self.actions):
+                output = io.StringIO()
+                with redirect_stdout(output):
+                    result = action()
+                next_state = self._next_id(result, row // len(self.events))
+                self.next_states[row] = next_state
+                outcomes.append((next_state, output.getvalue().rstrip("\n")))
+            self._outcomes = outcomes
+        return self._outcomes
+
+
+LAPTOP_STATE_MACHINE = StateMachine([LaptopOff, LaptopOn])
+
+
 class Laptop:
     def __init__(self):
-        self.state = LaptopOff()
+        self.machine = LAPTOP_STATE_MACHINE
+        self._state = self.machine.state_ids[LaptopOff]
+
+    @property
+    def state(self) -> LaptopState:
+        return self.machine.states[self._state]
+
+    @state.setter
+    def state(self, state: LaptopState):
+        self._state = self.machine.state_ids[type(state)]
 
     def power_button(self):
-        self.state = self.state.power_button()
+        self._state = self.machine.fire(self._state, POWER_BUTTON)
 
     def volume_up_button(self):
-        self.state.volume_up_button()
+        self._state = self.machine.fire(self._state, VOLUME_UP_BUTTON)
 
     def volume_down_button(self):
-        self.state.volume_down_button()
+        self._state = self.machine.fire(self._state, VOLUME_DOWN_BUTTON)
 
     def type_words(self):
-        self.state.type_words()
+        self._state = self.machine.fire(self._state, TYPE_WORDS)
+
+
+class Fleet:
+    """
+    Simulates lots of laptops at once. Each device's state is one byte in a bytearray, rather than a Laptop object.
+    Events go through the same transition table as Laptop, turned into 256-byte translation tables so that
+    bytes.translate applies an event to every device in one call. Events come either as a single event for every
+    device, or as one event per device (a bytes-like object). Each call returns the outcome of the event for every
+    device, as indexes into self.messages.
+    """
+
+    def __init__(self, devices: int, machine: StateMachine = LAPTOP_STATE_MACHINE):
+        width = len(machine.events)
+        if len(machine.states) * width > 256:
+            raise ValueError("too many states and events to fit in a byte")
+        self.machine = machine
+        outcomes = machine.outcomes()
+        self.messages = list(dict.fromkeys(message for _, message in outcomes))
+        message_ids = {message: i for i, message in enumerate(self.messages)}
+        # indexed by 'state * len(events) + event', like the machine's table
+        self._next = bytes(next_state for next_state, _ in outcomes).ljust(256, b"\0")
+        self._outcomes = bytes(message_ids[message] for _, message in outcomes).ljust(256, b"\0")
+        # indexed by state, one table per event
+        states = range(len(machine.states))
+        self._next_by_event = [
+            bytes(self._next[state * width + event] for state in states).ljust(256, b"\0") for event in range(width)
+        ]
+        self._outcomes_by_event = [
+            bytes(self._outcomes[state * width + event] for state in states).ljust(256, b"\0")
+            for event in range(width)
+        ]
+        self.states = bytearray([machine.state_ids[LaptopOff]]) * devices
+
+    def __len__(self):
+        return len(self.states)
+
+    def apply(self, events: int | bytes | bytearray) -> bytes:
+        """Apply the event(s) to every device, returns each device's outcome"""
+        width = len(self.machine.events)
+        if isinstance(events, int):
+            if not 0 <= events < width:
+                raise ValueError(f"unknown event {events}")
+            outcomes = bytes(self.states.translate(self._outcomes_by_event[events]))
+            self.states = self.states.translate(self._next_by_event[events])
+            return outcomes
+        if len(events) != len(self.states):
+            raise ValueError("expected one event per device")
+        if events and max(events) >= width:
+            raise ValueError("unknown event in the batch")
+        keys = bytes(map(operator.add, map(width.__mul__, self.states), events))
+        self.states = bytearray(keys.translate(self._next))
+        return keys.translate(self._outcomes)
+
+    def count(self, state_class: type[LaptopState]) -> int:
+        return self.states.count(self.machine.state_ids[state_class])
 
 
 def main():
@@ -83,6 +209,43 @@ def main():
     laptop.volume_down_button()
     laptop.type_words()
 
+    # A whole fleet of laptops can be simulated at once
+    fleet = Fleet(5)
+    fleet.apply(bytes([POWER_BUTTON, POWER_BUTTON, TYPE_WORDS, POWER_BUTTON, VOLUME_UP_BUTTON]))
+    outcomes = fleet.apply(TYPE_WORDS)
+    print(f"{fleet.count(LaptopOn)} of {len(fleet)} laptops on:", [fleet.messages[outcome] for outcome in outcomes])
+
+
+def benchmark(events: int = 1_000_000):
+    """Events per second through the transition table, against calling the state objects directly"""
+    sequence = [i % len(EVENTS) for i in range(events)]
+
+    def state_objects():
+        state = LaptopOff()
+        for event in sequence:
+            if event == POWER_BUTTON:
+                state = state.power_button()
+            else:
+                getattr(state, EVENTS[event])()
+
+    def table():
+        laptop = Laptop()
+        handlers = [getattr(laptop, event) for event in EVENTS]
+        for event in sequence:
+            handlers[event]()
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        runs = (
+            ("state objects", state_objects),
+            ("table", table),
+        )
+        timings = [(name, min(timeit.repeat(run, number=1, repeat=3))) for name, run in runs]
+    for name, seconds in timings:
+        print(f"{name:>13}: {events / seconds:,.0f} events/s")
+
 
 if __name__ == "__main__":
-    main()
+    if "--benchmark" in sys.argv:
+        benchmark()
+    else:
+        main()
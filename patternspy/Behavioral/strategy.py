@@ -2,7 +2,26 @@
 # A relatively simple pattern that allows us to change the behavior of an object at runtime by changing the strategy
 # object. It's easy to tell when the strategy pattern is being used. Look for classes (the context)
 # that have nested objects doing the work with a setter to interchange that object (the strategy).
+import heapq
+import operator
+import os
+import random
+import tempfile
 from abc import abstractmethod, ABC
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
 
 
 class Sorter(ABC):
@@ -41,6 +60,278 @@ class InsertionSort(Sorter):
         return data
 
 
+class MergeSort(Sorter):
+    """
+    Bottom up merge sort, O(n log n) no matter the input. Merges runs of width 1, 2, 4... into a buffer,
+    then swaps the roles of the data and buffer for the next pass.
+    """
+
+    def sort(self, data: list[int]):
+        source, target = list(data), [None] * len(data)
+        width = 1
+        while width < len(data):
+            for start in range(0, len(data), 2 * width):
+                middle, end = min(start + width, len(data)), min(start + 2 * width, len(data))
+                i, j, k = start, middle, start
+                while i < middle and j < end:
+                    if source[j] < source[i]:
+                        target[k] = source[j]
+                        j += 1
+                    else:
+                        target[k] = source[i]
+                        i += 1
+                    k += 1
+                target[k:end] = source[i:middle] if i < middle else source[j:end]
+            source, target = target, source
+            width *= 2
+        data[:] = source
+        return data
+
+
+class HeapSort(Sorter):
+    """
+    Heap sort, O(n log n) and sorts in place without any extra memory.
+    Builds a max heap, then repeatedly swaps the largest item to the end of the list.
+    """
+
+    def sort(self, data: list[int]):
+        def sift_down(root: int, end: int):
+            while (child := 2 * root + 1) < end:
+                if child + 1 < end and data[child] < data[child + 1]:
+                    child += 1
+                if data[root] >= data[child]:
+                    return
+                data[root], data[child] = data[child], data[root]
+                root = child
+
+        for root in range(len(data) // 2 - 1, -1, -1):
+            sift_down(root, len(data))
+        for end in range(len(data) - 1, 0, -1):
+            data[0], data[end] = data[end], data[0]
+            sift_down(0, end)
+        return data
+
+
+class CountingSort(Sorter):
+    """
+    Counting sort for ints, O(n + k log k) for k distinct values. Great when there are a lot of repeated values.
+    The counting is done by collections.Counter, then each value is written back as one slice.
+    """
+
+    def sort(self, data: list[int]):
+        start = 0
+        for value, count in sorted(Counter(data).items()):
+            data[start:start + count] = [value] * count
+            start += count
+        return data
+
+
+class RadixSort(Sorter):
+    """
+    LSD radix sort for ints, a byte at a time, O(n * bytes). Negative numbers are shifted up by the minimum first.
+    """
+
+    def sort(self, data: list[int]):
+        if not data:
+            return data
+        low = min(data)
+        values = [value - low for value in data]
+        shift, largest = 0, max(values)
+        while largest >> shift:
+            buckets = [[] for _ in range(256)]
+            for value in values:
+                buckets[(value >> shift) & 0xFF].append(value)
+            values = [value for bucket in buckets for value in bucket]
+            shift += 8
+        data[:] = [value + low for value in values]
+        return data
+
+
+class TimSort(Sorter):
+    """Python's built-in sort (Timsort), O(n log n) and close to O(n) on data that's already mostly sorted"""
+
+    def sort(self, data: list[int]):
+        data.sort()
+        return data
+
+
+class AutoSorter(Sorter):
+    """
+    Picks a strategy based on the data, so callers don't have to:
+      - short lists go to insertion sort, it has the least overhead
+      - mostly sorted data goes to Timsort, it merges the existing runs in close to one pass
+        (this beats counting sort even when there are only a few distinct values)
+      - ints with few distinct values (at most one per 8 items) go to counting sort
+      - everything else goes to Timsort
+    Radix, merge and heap sort are never picked: they loop in Python, so the C Timsort
+    beats them on every input we measured. They're still there if you want them explicitly.
+    The strategy picked for the last call is kept in last_strategy.
+    """
+
+    small = 32
+
+    def __init__(self):
+        self.last_strategy: Sorter | None = None
+
+    def choose(self, data: list[int]) -> Sorter:
+        if len(data) <= self.small:
+            return InsertionSort()
+        # the number of places where the next item is smaller, 0 means it's already sorted
+        descents = sum(map(operator.gt, data, islice(data, 1, None)))
+        if descents <= len(data) // 16:
+            return TimSort()
+        if set(map(type, data)) == {int} and len(set(data)) <= len(data) // 8:
+            return CountingSort()
+        return TimSort()
+
+    def sort(self, data: list[int]):
+        self.last_strategy = self.choose(data)
+        return self.last_strategy.sort(data)
+
+
+class BufferSort(Sorter):
+    """
+    Sorts anything that supports the buffer protocol (array.array, bytearray, mmap, a writable memoryview...)
+    in place, through a memoryview, and returns the same object.
+    If NumPy is installed, a contiguous buffer is wrapped with numpy.frombuffer (no copy) and sorted by NumPy in C.
+    Without it, single byte items in a contiguous buffer are counted and written back as runs of bytes,
+    and wider items are copied out with sorted() and written back through the view in one slice assignment.
+    That copy is a list of boxed items, so it peaks at around 6x the buffer's size on top of the buffer itself.
+    """
+
+    formats = "bBhHiIlLqQfd"
+
+    def sort(self, data):
+        with memoryview(data) as view:
+            if view.readonly:
+                raise TypeError(f"can't sort a read-only {type(data).__name__} in place")
+            item_format = view.format.lstrip("@")
+            if item_format not in self.formats:
+                raise TypeError(f"can't sort items of format {view.format!r}")
+            flat = view if view.ndim == 1 else view.cast("B").cast(item_format)
+            if numpy is not None and flat.c_contiguous:
+                numpy.frombuffer(flat, dtype=item_format).sort()
+            elif flat.itemsize == 1 and flat.c_contiguous:
+                self._sort_bytes(flat.cast("B"), signed=item_format == "b")
+            else:
+                flat[:] = array(item_format, sorted(flat))
+        return data
+
+    @staticmethod
+    def _sort_bytes(view: memoryview, signed: bool):
+        counts = Counter(view)
+        # as unsigned bytes, negative numbers are 128-255 so they need to come first
+        order = [*range(128, 256), *range(128)] if signed else range(256)
+        start = 0
+        for value in order:
+            count = counts.get(value, 0)
+            if count:
+                view[start:start + count] = bytes([value]) * count
+                start += count
+
+
+def _sort_run(input_path: str, item_format: str, start: int, count: int, run_path: str) -> str:
+    """Sort 'count' items of the input, starting at item 'start', into a run file"""
+    values = array(item_format)
+    with open(input_path, "rb") as f:
+        f.seek(start * values.itemsize)
+        values.fromfile(f, count)
+    with open(run_path, "wb") as f:
+        array(item_format, sorted(values)).tofile(f)
+    return run_path
+
+
+def _read_run(path: str, item_format: str, block_items: int):
+    """Yield the items of a run file, reading it a block at a time"""
+    with open(path, "rb") as f:
+        while True:
+            block = array(item_format)
+            try:
+                block.fromfile(f, block_items)
+            except EOFError:
+                pass  # the last block is short, fromfile still keeps what it read
+            if not block:
+                return
+            yield from block
+
+
+def _open_file_limit() -> int:
+    if resource is None:
+        return 512  # the C runtime's default on Windows
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    return soft if soft != resource.RLIM_INFINITY else 2 ** 20
+
+
+class ExternalSort(Sorter):
+    """
+    Sorts a binary file of ints (in the array module's 'item_format') that doesn't fit in memory.
+    The file is read in chunks that fit in 'memory_budget' bytes, each chunk is sorted and written to a temporary
+    run file, optionally in parallel on a pool of 'workers' processes (the budget is then split between them).
+    The runs are then merged with a heap (heapq.merge), reading each run a block at a time. If there are more runs
+    than the budget has room for blocks, they're merged in several passes. A pass merges at most 'max_fan_in' runs,
+    and never more than half the process's open file limit, since every run being merged is an open file.
+    Unlike the other strategies, sort takes the path of the input file, and returns the path of the sorted output.
+    """
+
+    # roughly what sorting one item in memory costs on top of its own size: the boxed int and the list pointer
+    item_overhead = 40
+    min_block_items = 1024
+    max_fan_in = 512
+
+    def __init__(self, memory_budget: int = 64 * 2 ** 20, item_format: str = "q", workers: int | None = None,
+                 temp_dir: str | None = None):
+        self.memory_budget = memory_budget
+        self.item_format = item_format
+        self.itemsize = array(item_format).itemsize
+        self.workers = workers
+        self.temp_dir = temp_dir
+
+    def sort(self, data: str, output_path: str | None = None) -> str:
+        output_path = output_path or f"{data}.sorted"
+        total, extra = divmod(os.path.getsize(data), self.itemsize)
+        if extra:
+            raise ValueError(f"{data} isn't a whole number of {self.itemsize} byte items ({extra} bytes left over)")
+        chunk = max(1, self.memory_budget // (self.workers or 1) // (2 * self.itemsize + self.item_overhead))
+        with tempfile.TemporaryDirectory(dir=self.temp_dir) as tmp:
+            jobs = [
+                (data, self.item_format, start, min(chunk, total - start), os.path.join(tmp, f"run-{i}"))
+                for i, start in enumerate(range(0, total, chunk))
+            ]
+            if self.workers and len(jobs) > 1:
+                with ProcessPoolExecutor(self.workers) as pool:
+                    runs = list(pool.map(_sort_run, *zip(*jobs)))
+            else:
+                runs = [_sort_run(*job) for job in jobs]
+
+            fan_in = max(2, min(self.memory_budget // (self.itemsize * self.min_block_items) - 1, self.max_fan_in,
+                                _open_file_limit() // 2))
+            merge_pass = 0
+            while len(runs) > fan_in:
+                merged = []
+                for i in range(0, len(runs), fan_in):
+                    merged.append(os.path.join(tmp, f"merge-{merge_pass}-{i}"))
+                    self._merge(runs[i:i + fan_in], merged[-1])
+                runs = merged
+                merge_pass += 1
+            self._merge(runs, output_path)
+        return output_path
+
+    def _merge(self, runs: list[str], output_path: str):
+        # one block per run, plus one for the output
+        block_items = max(self.min_block_items, self.memory_budget // ((len(runs) + 1) * self.itemsize))
+        readers = [_read_run(run, self.item_format, block_items) for run in runs]
+        with open(output_path, "wb") as f:
+            block = array(self.item_format)
+            for value in heapq.merge(*readers):
+                block.append(value)
+                if len(block) >= block_items:
+                    block.tofile(f)
+                    block = array(self.item_format)
+            block.tofile(f)
+        for run in runs:
+            os.remove(run)
+
+
 class ClientContext:
     """
     This (poorly named) class is the context for the strategy pattern.
@@ -49,6 +340,8 @@ class ClientContext:
 
     def __init__(self):
         self._strategy: Sorter | None = None
+        self.auto_sorter = AutoSorter()
+        self.buffer_sorter = BufferSort()
 
     @property
     def strategy(self):
@@ -59,7 +352,18 @@ class ClientContext:
         self._strategy = strategy
 
     def sort(self, data: list[int]):
-        return self.strategy.sort(data)
+        if self.strategy:
+            return self.strategy.sort(data)
+        if not isinstance(data, list):
+            try:
+                memoryview(data).release()
+            except TypeError:
+                pass
+            else:
+                # buffers (array.array, bytearray, ...) are sorted in place, without turning them into a list
+                return self.buffer_sorter.sort(data)
+        # without a strategy, let the AutoSorter pick one
+        return self.auto_sorter.sort(data)
 
 
 def main():
@@ -73,6 +377,32 @@ def main():
     ctx.strategy = InsertionSort()
     insertion_sorted_data = ctx.sort(data1)
     print("insertion sort ", insertion_sorted_data)
+    for strategy in (MergeSort(), HeapSort(), CountingSort(), RadixSort(), TimSort()):
+        ctx.strategy = strategy
+        print(f"{strategy.__class__.__name__} ", ctx.sort([1, 3, 6, 2, 4, 1, 9, 5]))
+
+    # If we don't set a strategy, the context picks one for us
+    ctx.strategy = None
+    data2 = [n % 10 for n in range(1000)]
+    ctx.sort(data2)
+    print("auto sort picked", ctx.auto_sorter.last_strategy.__class__.__name__)
+
+    # Buffers are sorted in place, we get the same buffer back
+    buffer = array("q", [1, 3, 6, 2, 4, 1, 9, 5])
+    print("buffer sort ", ctx.sort(buffer), ctx.sort(buffer) is buffer)
+
+    # Data too big for memory can be sorted on disk, here with a tiny memory budget to force lots of runs
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "ints.bin")
+        with open(path, "wb") as f:
+            array("q", (random.randint(-10 ** 9, 10 ** 9) for _ in range(100_000))).tofile(f)
+        external = ExternalSort(memory_budget=64 * 1024)
+        ctx.strategy = external
+        sorted_path = ctx.sort(path)
+        result = array("q")
+        with open(sorted_path, "rb") as f:
+            result.frombytes(f.read())
+        print(f"external sort of {len(result):,} ints, sorted: {all(map(operator.le, result, result[1:]))}")
 
 
 if __name__ == "__main__":